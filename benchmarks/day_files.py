@@ -0,0 +1,56 @@
+#%%
+# day file formats: gzip pickle of the full frame vs. the compact zstd parquet schema.
+# usage: python benchmarks/day_files.py [osm_map_changes_data/YYYY-MM-DD.pkl.gzip]
+# without a path, a synthetic day with 400k rows is generated.
+import sys, os, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pandas as pd
+
+from aggregator import AGGREGATION_COLUMNS
+from day_files import write_changes_file, read_changes_file
+
+
+def generate_day(n=400000):
+    rng = np.random.default_rng(0)
+    keys = np.array(['highway', 'name', 'surface', 'lanes', 'maxspeed', 'oneway', 'building', 'addr:street'])
+    tags_keys = [list(rng.choice(keys, k, replace=False)) for k in rng.integers(0, 6, n)]
+    return pd.DataFrame({
+        'id': rng.integers(1, 10**10, n),
+        'version': rng.integers(1, 30, n),
+        'timestamp': pd.date_range('2021-06-01', periods=n, freq='200ms').floor('s').strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'uid': rng.integers(1, 50000, n),
+        'user': [f'user{u}' for u in rng.integers(0, 20000, n)],
+        'changeset': rng.integers(10**8, 10**8 + 30000, n),
+        'lat': rng.uniform(-60, 70, n),
+        'lon': rng.uniform(-170, 170, n),
+        'operation': pd.Categorical(rng.choice(['create', 'modify', 'delete'], n)),
+        'element': pd.Categorical(rng.choice(['node', 'way', 'relation'], n, p=[0.6, 0.35, 0.05])),
+        'tags_keys': tags_keys,
+        'tags_values': [[f'v{v}' for v in rng.integers(0, 500, len(k))] for k in tags_keys],
+        'road_type': rng.choice(['residential', 'service', 'primary', None], n),
+        'visible': rng.choice(['true', 'false', None], n),
+        'country': pd.Categorical(rng.choice(['United States', 'Germany', 'France', 'India', 'Brazil'], n)),
+        'state': pd.Categorical(rng.choice(['Texas', 'Germany', 'France', 'India', 'Brazil'], n)),
+    })
+
+
+def timed(name, func):
+    start = time.perf_counter()
+    result = func()
+    print(f'{name:32s} {time.perf_counter() - start:8.2f} s')
+    return result
+
+
+if __name__ == '__main__':
+    df = pd.read_pickle(sys.argv[1], compression='gzip') if len(sys.argv) > 1 else generate_day()
+    folder = tempfile.mkdtemp()
+    pickle_file, parquet_file = f'{folder}/day.pkl.gzip', f'{folder}/day.parquet'
+
+    timed('pickle write', lambda: df.to_pickle(pickle_file, compression='gzip'))
+    timed('parquet write', lambda: write_changes_file(df, parquet_file))
+    timed('pickle read', lambda: pd.read_pickle(pickle_file, compression='gzip'))
+    timed('parquet read (all columns)', lambda: read_changes_file(parquet_file))
+    timed('parquet read (aggregation)', lambda: read_changes_file(parquet_file, AGGREGATION_COLUMNS))
+    print(f'pickle {os.path.getsize(pickle_file) / 2**20:.1f} MB, parquet {os.path.getsize(parquet_file) / 2**20:.1f} MB')
@@ -0,0 +1,63 @@
+#%%
+# do_aggregation_db on a day file: get_dummies + groupby with Python lambdas vs. the first/max path.
+# usage: python benchmarks/db_aggregation.py [osm_map_changes_data/YYYY-MM-DD.pkl.gzip]
+# without a path, a synthetic day with 1M rows over 60k changesets is generated.
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pandas as pd
+
+from aggregator import do_aggregation_db, classify_road_types
+
+
+def lambda_aggregation_db(df):
+    return pd.get_dummies(df, columns=['element', 'operation']).groupby(by=['changeset','road_type']).agg({
+        'day': lambda x: x.iloc[0],
+        'country': lambda x: x.iloc[0],
+        'state': lambda x: x.iloc[0],
+        'element_node': any,
+        'element_relation': any,
+        'element_way': any,
+        'operation_create': any,
+        'operation_modify': any,
+        'lat':lambda x: x.iloc[0],
+        'lon':lambda x: x.iloc[0],
+    }).reset_index(level=[0,1])
+
+
+def generate_day(n=1000000, changesets=60000):
+    rng = np.random.default_rng(0)
+    countries = np.array(['United States', 'Germany', 'France', 'India', 'Brazil', None], dtype=object)
+    country = rng.choice(countries, n, p=[0.3, 0.2, 0.15, 0.15, 0.15, 0.05])
+    return pd.DataFrame({
+        'changeset': rng.integers(10**8, 10**8 + changesets, n),
+        'road_type': rng.choice(['residential', 'service', 'primary', 'footway', 'restriction:no_left_turn'], n),
+        'day': '2021-06-01',
+        'country': pd.Categorical(country),
+        'state': pd.Categorical(country),
+        'element': pd.Categorical(rng.choice(['node', 'way', 'relation'], n, p=[0.6, 0.35, 0.05])),
+        'operation': pd.Categorical(rng.choice(['create', 'modify', 'delete'], n)),
+        'lat': rng.uniform(-60, 70, n),
+        'lon': rng.uniform(-170, 170, n),
+    })
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        df = pd.read_pickle(sys.argv[1], compression='gzip')
+        df['day'] = sys.argv[1][-19:-9]
+        if 'road_type' not in df:
+            df['road_type'] = classify_road_types(df)
+    else:
+        df = generate_day()
+
+    results = {}
+    for name, func in [('get_dummies + lambdas', lambda_aggregation_db), ('first/max', do_aggregation_db)]:
+        start = time.perf_counter()
+        results[name] = func(df)
+        seconds = time.perf_counter() - start
+        print(f'{name:22s} {len(df):>10,} rows  {seconds:8.2f} s  {len(df) / seconds:>12,.0f} rows/s')
+
+    old, new = results.values()
+    print('same output:', old.astype(str).equals(new[old.columns].astype(str)))
@@ -0,0 +1,50 @@
+#%%
+# Parse throughput of a daily diff file: whole tree + per-element dicts vs. streaming columnar builder.
+# usage: python benchmarks/diff_parsing.py [path/to/day.osc.gz]
+# without a path, a synthetic diff with ~200k elements is generated.
+import sys, os, gzip, random, shutil, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from crawler import OSM_Chagneset_Analysis
+
+
+def generate_diff_file(path, n_elements=200000):
+    random.seed(0)
+    with gzip.open(path, 'wt') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6" generator="benchmark">\n')
+        for i in range(n_elements):
+            op = random.choice(['modify', 'delete', 'create'])
+            element = random.choice(['node', 'node', 'way', 'relation'])
+            attrib = f'id="{i}" version="{random.randint(1, 20)}" timestamp="2021-06-01T12:00:00Z" uid="{random.randint(1, 10**6)}" user="user{random.randint(1, 5000)}" changeset="{random.randint(10**8, 10**8 + 10**5)}"'
+            if element == 'node':
+                attrib += f' lat="{random.uniform(-60, 70):.7f}" lon="{random.uniform(-170, 170):.7f}"'
+            tags = ''
+            if random.random() < 0.5:
+                tags = '<tag k="highway" v="residential"/><tag k="name" v="Main Street"/><tag k="surface" v="asphalt"/>'
+            inner = '<nd ref="1"/><nd ref="2"/>' if element == 'way' else ''
+            f.write(f'<{op}><{element} {attrib}>{inner}{tags}</{element}></{op}>\n')
+        f.write('</osmChange>\n')
+
+
+def run(streaming, day):
+    start = time.perf_counter()
+    df = OSM_Chagneset_Analysis(day).process_diff_files(streaming=streaming)
+    return len(df), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    day = '2021-06-01'
+    workdir = tempfile.mkdtemp()
+    os.makedirs(f'{workdir}/diff_{day}')
+    target = f'{workdir}/diff_{day}/0.osc.gz'
+    if len(sys.argv) > 1:
+        shutil.copy(sys.argv[1], target)
+    else:
+        generate_diff_file(target)
+
+    os.chdir(workdir)
+    for name, streaming in [('tree + dicts', False), ('streaming columnar', True)]:
+        rows, seconds = run(streaming, day)
+        print(f'{name:20s} {rows:>10,} rows  {seconds:8.2f} s  {rows / seconds:>12,.0f} rows/s')
+
+    shutil.rmtree(workdir)
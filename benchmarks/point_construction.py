@@ -0,0 +1,32 @@
+#%%
+# rows/sec of building point geometries from lon/lat columns: row-wise apply vs. vectorized points_from_lonlat.
+# usage: python benchmarks/point_construction.py [n_rows]
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pandas as pd
+import geopandas
+from shapely.geometry import Point
+
+from spatial import points_from_lonlat
+
+
+def apply_points(df):
+    return geopandas.GeoDataFrame(df, geometry=df[['lon','lat']].apply(lambda p: Point(*(p.values)), axis=1)).set_crs(4326)
+
+
+def vectorized_points(df):
+    return geopandas.GeoDataFrame(df, geometry=points_from_lonlat(df), crs=4326)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'lon': rng.uniform(-180, 180, n), 'lat': rng.uniform(-90, 90, n)})
+
+    for name, func in [('apply', apply_points), ('points_from_lonlat', vectorized_points)]:
+        start = time.perf_counter()
+        func(df)
+        seconds = time.perf_counter() - start
+        print(f'{name:20s} {n:>10,} rows  {seconds:8.2f} s  {n / seconds:>14,.0f} rows/s')
@@ -8,34 +8,292 @@
 
 
 import requests 
-import re
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 
 import geopandas
-from geopandas.tools import sjoin
-from shapely.geometry import Point
+from spatial import points_from_lonlat, BoundaryIndex
 
 import xml.etree.ElementTree as ET
 import gzip
 import pandas as pd 
+import numpy as np
 import glob, os
+from array import array
+from itertools import chain
 
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 from pathlib import Path
-from tqdm.contrib.concurrent import thread_map
+from tqdm.contrib.concurrent import thread_map, process_map
 from concurrent.futures import ThreadPoolExecutor
 
-
+from downloader import AsyncDownloader, DownloadCache, MissingFilesError
+from replication_index import ReplicationSequenceIndex
+
+
+
+
+OPERATIONS = ['modify', 'delete', 'create']
+ELEMENTS = ['node', 'way', 'relation']
+# (tag key, prefix) in priority order: highway first, then restriction and junction
+ROAD_TYPE_TAGS = [('highway', ''), ('restriction', 'restriction:'), ('junction', 'junction:')]
+ROAD_TAGS = {key for key, _ in ROAD_TYPE_TAGS}
+
+
+# road/feature type of an element from its tags, the first ROAD_TYPE_TAGS key it has
+def road_type(tags):
+    for key, prefix in ROAD_TYPE_TAGS:
+        if key in tags:
+            return prefix + tags[key]
+
+
+# streams the (operation, element, tags) of road related elements out of an osmChange file.
+# Instead of loading the whole daily diff into a tree, the file is parsed incrementally and every
+# element is cleared and detached once consumed, so memory stays flat regardless of the diff size.
+# Elements are yielded in document order, not grouped by operation like iterating the full tree.
+def iterparse_diffs(f):
+    root = None
+    op = None
+    with gzip.open(f, 'rb') as stream:
+        for event, elem in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                elif elem.tag in OPERATIONS and op is None:
+                    op = elem
+                continue
+
+            if op is not None and elem.tag in ELEMENTS and elem in op:
+                tags = {t.attrib['k'] : t.attrib['v'] for t in elem.iter('tag')}
+                if ROAD_TAGS.intersection(tags.keys()):
+                    yield op.tag, elem, tags
+                elem.clear()
+                op.remove(elem)
+            elif elem is op:
+                elem.clear()
+                root.remove(elem)
+                op = None
+
+
+
+# column oriented accumulator for parsed diff elements. Values are appended straight into typed
+# arrays (no dict per element) and the DataFrame is built in one shot at the end.
+class DiffColumns:
+    INT_FIELDS = ['id', 'version', 'uid', 'changeset']
+    FLOAT_FIELDS = ['lat', 'lon']
+    STR_FIELDS = ['timestamp', 'user']
+    KNOWN_ATTRIBUTES = set(INT_FIELDS + FLOAT_FIELDS + STR_FIELDS)
+
+    def __init__(self):
+        self.ints = {field: array('q') for field in self.INT_FIELDS}
+        self.floats = {field: array('d') for field in self.FLOAT_FIELDS}
+        self.strs = {field: [] for field in self.STR_FIELDS}
+        self.missing_uid = False
+        self.operations = array('b')
+        self.elements = array('b')
+        self.tags_keys = []
+        self.tags_values = []
+        self.road_types = []
+        # any other attribute (e.g. visible) is kept as an object column, None when absent
+        self.extra = {}
+        self.length = 0
+
+    def append(self, op, element, tags):
+        attrib = element.attrib
+        ints = self.ints
+        ints['id'].append(int(attrib['id']))
+        ints['version'].append(int(attrib['version']))
+        ints['changeset'].append(int(attrib['changeset']))
+        uid = attrib.get('uid')
+        if uid is None:
+            self.missing_uid = True
+            uid = -1
+        ints['uid'].append(int(uid))
+
+        self.floats['lat'].append(float(attrib.get('lat', 'nan')))
+        self.floats['lon'].append(float(attrib.get('lon', 'nan')))
+        self.strs['timestamp'].append(attrib.get('timestamp'))
+        self.strs['user'].append(attrib.get('user'))
+
+        self.operations.append(OPERATIONS.index(op))
+        self.elements.append(ELEMENTS.index(element.tag))
+        self.tags_keys.append(list(tags.keys()))
+        self.tags_values.append(list(tags.values()))
+        self.road_types.append(road_type(tags))
+
+        for key in attrib.keys() - self.KNOWN_ATTRIBUTES:
+            if key not in self.extra:
+                self.extra[key] = [None] * self.length
+        for key, values in self.extra.items():
+            values.append(attrib.get(key))
+        self.length += 1
+
+    # compact columnar form of the parsed rows: numpy buffers only, tags flattened to offsets + values.
+    # This is what parsing workers send back, it pickles much smaller than a DataFrame of lists.
+    def to_columns(self):
+        uid = np.frombuffer(self.ints['uid'], dtype=np.int64)
+        if self.missing_uid:
+            uid = np.where(uid == -1, np.nan, uid)
+
+        tags_offsets = np.zeros(self.length + 1, dtype=np.int64)
+        np.cumsum([len(keys) for keys in self.tags_keys], out=tags_offsets[1:])
+
+        return {
+            'id': np.frombuffer(self.ints['id'], dtype=np.int64),
+            'version': np.frombuffer(self.ints['version'], dtype=np.int64),
+            'timestamp': np.array(self.strs['timestamp'], dtype=object),
+            'uid': uid,
+            'user': np.array(self.strs['user'], dtype=object),
+            'changeset': np.frombuffer(self.ints['changeset'], dtype=np.int64),
+            'lat': np.frombuffer(self.floats['lat'], dtype=np.float64),
+            'lon': np.frombuffer(self.floats['lon'], dtype=np.float64),
+            'operation': np.frombuffer(self.operations, dtype=np.int8),
+            'element': np.frombuffer(self.elements, dtype=np.int8),
+            'tags_offsets': tags_offsets,
+            'tags_keys': np.array(list(chain.from_iterable(self.tags_keys)), dtype=object),
+            'tags_values': np.array(list(chain.from_iterable(self.tags_values)), dtype=object),
+            'road_type': np.array(self.road_types, dtype=object),
+            'extra': {key: np.array(values, dtype=object) for key, values in self.extra.items()},
+        }
+
+    def to_dataframe(self):
+        return diff_columns_to_dataframe([self.to_columns()])
+
+
+# concatenates the columnar results of several diff files into one DataFrame
+def diff_columns_to_dataframe(parts):
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return DiffColumns().to_dataframe()
+
+    def concat(field):
+        return np.concatenate([part[field] for part in parts])
+
+    tags_keys = concat('tags_keys').tolist()
+    tags_values = concat('tags_values').tolist()
+    offsets = [0]
+    for part in parts:
+        offsets.extend((part['tags_offsets'][1:] + offsets[-1]).tolist())
+
+    extra = {}
+    for key in dict.fromkeys(chain.from_iterable(part['extra'] for part in parts)):
+        extra[key] = np.concatenate([part['extra'].get(key, np.full(len(part['id']), None, dtype=object)) for part in parts])
+
+    return pd.DataFrame({
+        'id': concat('id'),
+        'version': concat('version'),
+        'timestamp': concat('timestamp'),
+        'uid': concat('uid'),
+        'user': concat('user'),
+        'changeset': concat('changeset'),
+        'lat': concat('lat'),
+        'lon': concat('lon'),
+        'operation': pd.Categorical.from_codes(concat('operation'), categories=OPERATIONS),
+        'element': pd.Categorical.from_codes(concat('element'), categories=ELEMENTS),
+        'tags_keys': [tags_keys[a:b] for a, b in zip(offsets[:-1], offsets[1:])],
+        'tags_values': [tags_values[a:b] for a, b in zip(offsets[:-1], offsets[1:])],
+        'road_type': concat('road_type'),
+        **extra
+    })
+
+
+def parse_diff_file(f):
+    columns = DiffColumns()
+    for op, element, tags in iterparse_diffs(f):
+        columns.append(op, element, tags)
+    return columns.to_columns()
+
+
+
+# the old tree based parser (whole file in memory, road elements only), kept for streaming=False
+def parse_diff_file_tree(f):
+
+    def iter_diffs(xml):
+        operations = ['modify', 'delete', 'create']
+        for op in operations:
+            for diffs in xml.iter(op):
+                for element in diffs:        
+                    dict = element.attrib.copy()
+                    dict['operation'] = op
+                    dict['element'] = element.tag
+                    # for t in element.iter('tag'):
+                    #     if t.attrib['k'] in ['highway', 'restriction', 'junction']:
+                    #         dict['tag:' + t.attrib['k']] = t.attrib['v']
+
+                    tags = {t.attrib['k'] : t.attrib['v'] for t in element.iter('tag')}
+                    # tags, values = zip(*[(t.attrib['k'],t.attrib['v']) for t in element.iter('tag')])
+                    if {'highway', 'restriction', 'junction'}.intersection(tags.keys()):
+                        dict['tags_keys'] = list(tags.keys())
+                        dict['tags_values'] = list(tags.values())
+
+                        yield dict
+
+    xml = ET.parse(gzip.open(f,'rt')).getroot()
+    df = pd.DataFrame(list(iter_diffs(xml)))
+
+    numeric_fields = ['id','version','uid','changeset','lat','lon']
+    categorical_fields = ['element', 'operation'] + [col for col in df.columns if col.startswith('tag:')]
+    for field in numeric_fields:
+        df[field] = pd.to_numeric(df[field])
+
+    for field in categorical_fields:
+        df[field] = df[field].astype('category')
+    
+    return df
+
+
+
+# columnar form of a changesets replication file, numeric fields typed and everything else kept as strings.
+def parse_changesets_file(f):
+    numeric_fields = ['id', 'min_lat', 'max_lat', 'min_lon', 'max_lon']
+    try:
+        numeric = {field: array('d') for field in numeric_fields}
+        other = {}
+        length = 0
+        with gzip.open(f, 'rb') as stream:
+            for event, elem in ET.iterparse(stream):
+                if elem.tag != 'changeset':
+                    continue
+                attrib = elem.attrib
+                for field in numeric_fields:
+                    numeric[field].append(float(attrib.get(field, 'nan')))
+                for key in attrib.keys() - set(numeric_fields):
+                    if key not in other:
+                        other[key] = [None] * length
+                for key, values in other.items():
+                    values.append(attrib.get(key))
+                length += 1
+                elem.clear()
+
+        columns = {field: np.frombuffer(values, dtype=np.float64) for field, values in numeric.items()}
+        columns['id'] = columns['id'].astype(np.int64)
+        columns.update({key: np.array(values, dtype=object) for key, values in other.items()})
+        return columns
+    except Exception as e:
+        print(e)
+        return None
 
 
 
 class OSM_Chagneset_Analysis:
     FORMAT="%Y-%m-%d"
+    REPLICATION_URL = 'https://planet.openstreetmap.org/replication'
     #date_str: YYYY-MM-DD
     
-    def __init__(self, date_str):
+    # parse_executor: 'process' parses files in a process pool (parsing is CPU bound and threads are serialized by the GIL), 
+    # 'thread' keeps the old thread pool. parse_workers: pool size, defaults to the number of cores.
+    # replication_url: base url of the replication files, can point to a local server for testing.
+    # download_concurrency: number of files downloaded at the same time over pooled connections. The job runs up to
+    # 4 days' downloads at once (its download semaphore), so the default keeps it at 16 connections to the mirror.
+    # cache_folder, cache_max_bytes: on-disk cache of replication files shared between days and workers.
+    def __init__(self, date_str, parse_executor='process', parse_workers=None, replication_url=None, download_concurrency=4,
+                 cache_folder='download_cache', cache_max_bytes=50 * 2**30):
         self.date_str = date_str
+        self.replication_url = replication_url or self.REPLICATION_URL
+        self.downloader = AsyncDownloader(concurrency=download_concurrency)
+        self.cache = DownloadCache(cache_folder, cache_max_bytes)
+        self.parse_executor = parse_executor
+        self.parse_workers = parse_workers or os.cpu_count()
         self.diff_folder = f'diff_{date_str}'
         self.changesets_folder = f'changesets_{date_str}'
 
@@ -47,36 +305,18 @@ class OSM_Chagneset_Analysis:
                         status_forcelist=[ 500, 502, 503, 504 ])
 
         self.session.mount('http://', HTTPAdapter(max_retries=retries))
+        self.session.mount('https://', HTTPAdapter(max_retries=retries))
 
     
     
-    # approximation to find changeset files and diff files for the given day
-    # margin day before and day after. 
+    # changeset files covering the given day with a margin of a day before and a day after.
+    # The exact sequence range is found with the local replication sequence index (no directory listing).
     def get_changeset_range(self):
-        date_obj = datetime.strptime(self.date_str, self.FORMAT)
-        start_date_str = (date_obj + timedelta(days=-1)).strftime(self.FORMAT)
-        end_date_str = (date_obj + timedelta(days=1)).strftime(self.FORMAT)
-        changeset_files = []
-        response = self.session.get('https://planet.openstreetmap.org/replication/changesets/').text
-        lines = re.findall(r'(.*alt="\[DIR\]".*)', response)
-        for line in lines[-1::-1]:
-            last_modified = re.findall(r'a>\s*(.{10})', line)[0]
-            if last_modified >= start_date_str:
-                level1_dir = re.findall(r'href="(.*?)">',line)[0][:-1]
-                response2 = self.session.get('https://planet.openstreetmap.org/replication/changesets/' + level1_dir).text
-                lines2 = re.findall(r'(.*alt="\[DIR\]".*)', response2)
-                for line2 in lines2:
-                    last_modified = re.findall(r'a>\s*(.{10})', line2)[0]
-                    level2_dir = re.findall(r'href="(.*?)">',line2)[0][:-1]
-                    if last_modified >= start_date_str and last_modified <= end_date_str:
-                        changeset_files.append(level1_dir + level2_dir)
-
-        
-        if not changeset_files:
-           raise RuntimeError('No OSM diff files for this date yet.')
-
-
-        return range(int(min(changeset_files)+"000"), int(max(changeset_files)+"999")+1)
+        date_obj = datetime.strptime(self.date_str, self.FORMAT).replace(tzinfo=timezone.utc)
+        start = date_obj + timedelta(days=-1)
+        end = date_obj + timedelta(days=2)
+        index = ReplicationSequenceIndex(self.session, self.replication_url, stream='changesets')
+        return index.sequence_range(start, end)
         
 
     
@@ -89,117 +329,74 @@ class OSM_Chagneset_Analysis:
 
     
 
-    def download(self, args):
-        url, file = args
-        # try:
-        while not Path(file).exists() or Path(file).stat().st_size == 0:
-            open(file, 'wb+').write(self.session.get(url).content)
-        # except:
-            # return args
-        
-    
+    # downloads the given sequences of a replication stream into the shared cache (files already cached are not
+    # downloaded again, e.g. by the overlapping windows of consecutive days) and links them into the day folder.
+    # Raises MissingFilesError if any of them is not published (yet), rather than processing an incomplete day.
+    def download_sequences(self, stream, sequences, suffix, folder):
+        cached_files = {}
+        for i in sequences:
+            path = f'{i:011,}'.replace(',', '/')
+            cached_files[i] = (f'{self.replication_url}/{stream}/{path}{suffix}', self.cache.path(stream, i, suffix))
+
+        missing = set(self.downloader.download_all(list(cached_files.values())))
+        pending = cached_files
+        for attempt in range(3):
+            evicted = {}
+            for i, (url, cached) in pending.items():
+                if url not in missing and not self.cache.link(cached, f'{folder}/{i}{suffix}'):
+                    evicted[i] = (url, cached)
+            if not evicted or attempt == 2:
+                break
+            # evicted by another worker between the download and the link, fetch them again
+            missing |= set(self.downloader.download_all(list(evicted.values())))
+            pending = evicted
+        # still evicted after the last attempt (the cache is too small for the days downloading at once),
+        # the day fails instead of being parsed without them
+        missing |= {url for url, _ in evicted.values()}
+
+        self.cache.evict()
+        if missing:
+            raise MissingFilesError(f'{self.date_str}: {len(missing)} {stream} files not found or evicted, e.g. {sorted(missing)[0]}')
+
 
     def download_diff_files(self):
         self.clear_downloaded_data(diff=True, create_dirs=True)
-        diff = self.get_diff_range()
-        urls = []
-        for i in diff:
-            path = f'{i:011,}'.replace(',', '/')
-            url = f'https://planet.openstreetmap.org/replication/day/{path}.osc.gz'
-            file = f'{self.diff_folder}/{i}.osc.gz'
-            urls.append((url, file))
-
-        with ThreadPoolExecutor(4) as pool:
-            pool.map(self.download, urls)
+        self.download_sequences('day', self.get_diff_range(), '.osc.gz', self.diff_folder)
 
     
     def download_changeset_files(self):
         self.clear_downloaded_data(changesets=True, create_dirs=True)
-        changesets = self.get_changeset_range()
-        urls = []
-        for i in changesets:
-            path = f'{i:011,}'.replace(',', '/')
-            url = f'https://planet.openstreetmap.org/replication/changesets/{path}.osm.gz'
-            file = f'{self.changesets_folder}/{i}.osm.gz'
-            urls.append((url, file))
-        
-        with ThreadPoolExecutor(4) as pool:
-            pool.map(self.download, urls)
+        self.download_sequences('changesets', self.get_changeset_range(), '.osm.gz', self.changesets_folder)
 
         
 
 
-    def process_diff_files(self):
-
-        def process_single_diff_file(f):
+    def parallel_map(self, func, files, chunksize=1):
+        if self.parse_executor == 'process':
+            return process_map(func, files, max_workers=self.parse_workers, chunksize=chunksize)
+        return thread_map(func, files, max_workers=self.parse_workers)
 
-            def iter_diffs(xml):
-                operations = ['modify', 'delete', 'create']
-                for op in operations:
-                    for diffs in xml.iter(op):
-                        for element in diffs:        
-                            dict = element.attrib.copy()
-                            dict['operation'] = op
-                            dict['element'] = element.tag
-                            # for t in element.iter('tag'):
-                            #     if t.attrib['k'] in ['highway', 'restriction', 'junction']:
-                            #         dict['tag:' + t.attrib['k']] = t.attrib['v']
-
-                            tags = {t.attrib['k'] : t.attrib['v'] for t in element.iter('tag')}
-                            # tags, values = zip(*[(t.attrib['k'],t.attrib['v']) for t in element.iter('tag')])
-                            if {'highway', 'restriction', 'junction'}.intersection(tags.keys()):
-                                dict['tags_keys'] = list(tags.keys())
-                                dict['tags_values'] = list(tags.values())
-
-                                yield dict
-
-            xml = ET.parse(gzip.open(f,'rt')).getroot()
-            df = pd.DataFrame(list(iter_diffs(xml)))
-
-            numeric_fields = ['id','version','uid','changeset','lat','lon']
-            categorical_fields = ['element', 'operation'] + [col for col in df.columns if col.startswith('tag:')]
-            for field in numeric_fields:
-                df[field] = pd.to_numeric(df[field])
-
-            for field in categorical_fields:
-                df[field] = df[field].astype('category')
-            
-            return df
 
+    def process_diff_files(self, streaming=True):
         files = glob.glob(f"{self.diff_folder}/*.osc.gz")
-        dfs = []
+        if streaming:
+            return diff_columns_to_dataframe(self.parallel_map(parse_diff_file, files))
 
-        dfs = thread_map(process_single_diff_file, files, max_workers=6)
+        dfs = self.parallel_map(parse_diff_file_tree, files)
         diff_df = pd.concat(dfs,ignore_index=True)
         return diff_df
 
 
 
     def process_changesets_files(self):
-
-        def process_single_changesets_file(f):
-            
-            def iter_changesets(xml):
-                for cs in xml.iter('changeset'):
-                    yield cs.attrib.copy()
-
-            try:
-                xml = ET.parse(gzip.open(f,'rt')).getroot()
-                df = pd.DataFrame(list(iter_changesets(xml)))
-                if (len(df)):
-                    numeric_fields = ['id','min_lat','max_lat','min_lon','max_lon']
-                    for field in numeric_fields:
-                        df[field] = pd.to_numeric(df[field])
-                return df
-            except Exception as e:
-                print(e)
-                return None
-
-
         files = glob.glob(f"{self.changesets_folder}/*.osm.gz")
-        dfs = []
-        dfs = thread_map(process_single_changesets_file, files, max_workers=8)
-        changesets_df = pd.concat(dfs,ignore_index=True).drop_duplicates(subset='id').dropna(subset=['min_lon','min_lat','max_lon','max_lat'], how='any')
+        parts = [part for part in self.parallel_map(parse_changesets_file, files, chunksize=16) if part is not None]
+        fields = dict.fromkeys(chain.from_iterable(parts))
+        changesets_df = pd.DataFrame({
+            field: np.concatenate([part.get(field, np.full(len(part['id']), None, dtype=object)) for part in parts])
+            for field in fields
+        })
+        changesets_df = changesets_df.drop_duplicates(subset='id').dropna(subset=['min_lon','min_lat','max_lon','max_lat'], how='any')
         return changesets_df
 
 
@@ -226,34 +423,17 @@ class OSM_Chagneset_Analysis:
     # Constructing GeoDataFrame
     # GeoDataFrame is faster to query by bounding box.
     def create_geodataframe(self, data_df):
-        geom = data_df[['lon','lat']].apply(lambda p: Point(*(p.values)), axis=1)
-        data_gdf = geopandas.GeoDataFrame(data_df, geometry=geom).set_crs(4326)
+        data_gdf = geopandas.GeoDataFrame(data_df, geometry=points_from_lonlat(data_df), crs=4326)
         data_gdf.sindex
         return data_gdf
 
     
+    # country and U.S. state lookup in a single spatial join against the prebuilt boundary index,
+    # which is loaded once per process and reused for all the days handled by that process.
     def assign_countries(self, data_gdf):
-        countries = geopandas.read_file('misc/UIA_World_Countries_Boundaries_with_ISO3/World_Countries__Generalized_.shp')
-        countries.drop([col for col in countries.columns if col not in ['COUNTRYAFF','geometry']], axis = 1, inplace=True)
-        countries.sindex
-
-        joined = sjoin(data_gdf, countries, how='left').drop('index_right', axis=1)
-        data_gdf['country'] = joined['COUNTRYAFF']
-
-        states = geopandas.read_file('misc/us-states.json')
-        states = geopandas.GeoDataFrame(states.name, geometry=states.geometry)
-        states.sindex
-
-        us_only = geopandas.GeoDataFrame(data_gdf[data_gdf.country=='United States'], crs=4326)
-        joined = sjoin(us_only, states, how='left').drop('index_right', axis=1)
-        data_gdf['state'] = data_gdf['country']
-        data_gdf.loc[joined.index, 'state'] = joined['name']
-
-        data_gdf['state'] = data_gdf['state'].astype(object)
-        data_gdf.loc[pd.isna(data_gdf['state']), 'state'] = data_gdf.loc[pd.isna(data_gdf['state']), 'country'].astype(object)
-        data_gdf['state'] = data_gdf['state'].astype('category')
-        data_gdf['country'] = data_gdf['country'].astype('category')
-
+        country, state = BoundaryIndex.load().lookup(data_gdf)
+        data_gdf['country'] = country.astype('category')
+        data_gdf['state'] = state.astype('category')
         return data_gdf
 
 
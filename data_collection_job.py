@@ -6,12 +6,22 @@ from pathlib import Path
 
 from crawler import OSM_Chagneset_Analysis
 from aggregator import aggregate
+from store import AggregateStore, CountryTotals
+from day_files import CHANGES_FOLDER, write_changes_file
+from spatial import BoundaryIndex
+from db import BulkLoader
 from tqdm.contrib.concurrent import process_map
-import pandas as pd
 import json 
 import glob
+import os
+import traceback
 
 
+# parsing of diff/changeset files inside each day worker. Every day worker gets its own pool of
+# PARSE_WORKERS processes, so keep PARSE_WORKERS * DAY_WORKERS around the number of cores.
+DAY_WORKERS = 20
+PARSE_EXECUTOR = 'process'
+PARSE_WORKERS = max(1, os.cpu_count() // DAY_WORKERS)
 
 
 def daterange(start_date, end_date):
@@ -34,16 +44,16 @@ days = sorted(list(set(days + left_over)))
 
 
 if __name__ == "__main__":
-    def execute_crawling_cleaning_aggregation_workflow(download_lock, all_df_lock, day):
-        analayzer = OSM_Chagneset_Analysis(day)
+    def execute_crawling_cleaning_aggregation_workflow(download_lock, day):
+        analayzer = OSM_Chagneset_Analysis(day, parse_executor=PARSE_EXECUTOR, parse_workers=PARSE_WORKERS)
         
         ######### crawling 
 
         # only limited number of processed downloading at a time
-        download_lock.acquire()
-        analayzer.download_diff_files() 
-        analayzer.download_changeset_files()
-        download_lock.release()
+        # (released even if a download fails, e.g. the day is not published yet)
+        with download_lock:
+            analayzer.download_diff_files() 
+            analayzer.download_changeset_files()
 
         ######### cleaning & preperation
         diff_df = analayzer.process_diff_files()
@@ -52,8 +62,8 @@ if __name__ == "__main__":
         data = analayzer.create_geodataframe(data)
         data = analayzer.assign_countries(data)
 
-        Path('osm_map_changes_data').mkdir(exist_ok=True)
-        data.drop('geometry', axis=1).to_pickle(f'osm_map_changes_data/{day}.pkl.gzip', compression='gzip')
+        Path(CHANGES_FOLDER).mkdir(exist_ok=True)
+        write_changes_file(data.drop('geometry', axis=1), f'{CHANGES_FOLDER}/{day}.parquet')
 
 
         ############ aggregation
@@ -62,28 +72,56 @@ if __name__ == "__main__":
 
         ##### writing results back 
 
-        # make sure no one else is writing the data
-        all_df_lock.acquire()
-        all = pd.read_pickle('data/changes_aggregated/all.pkl.gzip', compression='gzip')
-        all = pd.concat([all, df]).sort_index(level='day')
-        all.to_pickle('data/changes_aggregated/all.pkl.gzip', compression='gzip')
-
-        # updat the status of the last availabe day, only if downloaded day is graater than existing days.
-        status = json.load(open('status.json'))
-        last_day = status['last_day']
-        if day > last_day:
-            status['last_day'] = day
-            json.dump(status, open('status.json', 'w'))
-        all_df_lock.release()
+        # only this day's partition is written, the store registers it in its manifest under its own lock
+        AggregateStore().write_partition(day, df)
 
         analayzer.clear_downloaded_data(diff=True, changesets=True)
+        return day
+
+    # a failing day (e.g. not published yet, a parse or db error) is reported and returns None instead of
+    # stopping the run: its downloaded files are kept for the next run, and the days that finished are published
+    def run_day(download_lock, day):
+        try:
+            return execute_crawling_cleaning_aggregation_workflow(download_lock, day)
+        except Exception:
+            print(f'{day} failed:')
+            traceback.print_exc()
+            return None
 
 
     print(datetime.now())
     print('crawling: ', days)
 
+    # migrate the old all.pkl.gzip into day partitions the first time the store is used
+    AggregateStore().import_legacy()
+
+    # the existing denominators count every day stored so far, recorded before the new days land
+    CountryTotals().baseline()
+
+    # build/load the boundary index once, the day workers are forked from here and inherit it
+    BoundaryIndex.load()
+
+    # changeset_ids and its day index, before the day workers start loading into it
+    BulkLoader().prepare()
+
     m = Manager()
     download_lock = m.Semaphore(4)
-    all_df_lock = m.Lock()
-    func = partial(execute_crawling_cleaning_aggregation_workflow, download_lock, all_df_lock)
-    process_map(func,days,max_workers=20)
+    func = partial(run_day, download_lock)
+    done = [day for day in process_map(func,days,max_workers=DAY_WORKERS) if day is not None]
+    print('failed: ', sorted(set(days) - set(done)))
+
+    # memory mapped copy of the whole history read by the dashboard
+    AggregateStore().write_history()
+
+    # apply the new days to the denominators of the percentage views
+    # (days of a failed run are picked up by the next one)
+    CountryTotals().update()
+
+    # updat the status of the last availabe day once all of the above is written,
+    # only if downloaded day is graater than existing days.
+    status = json.load(open('status.json'))
+    if done and max(done) > status['last_day']:
+        status['last_day'] = max(done)
+        tmp = f'status.json.{os.getpid()}.tmp'
+        json.dump(status, open(tmp, 'w'))
+        os.replace(tmp, 'status.json')
@@ -0,0 +1,89 @@
+#%%
+import os
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+CHANGES_FOLDER = 'osm_map_changes_data'
+
+# Compact schema of the daily changes files (parquet, zstd). Strings with few distinct values are dictionary
+# encoded, coordinates are float32 (~1m precision), timestamps are parsed and tags are stored as list columns,
+# i.e. one offsets array and one flat values array per column. Columns not listed here (other element
+# attributes) are stored dictionary encoded.
+CHANGES_SCHEMA = {
+    'id': pa.int64(),
+    'version': pa.int32(),
+    'timestamp': pa.timestamp('s', tz='UTC'),
+    'uid': pa.int64(),
+    'user': pa.dictionary(pa.int32(), pa.string()),
+    'changeset': pa.int64(),
+    'lat': pa.float32(),
+    'lon': pa.float32(),
+    'operation': pa.dictionary(pa.int8(), pa.string()),
+    'element': pa.dictionary(pa.int8(), pa.string()),
+    'tags_keys': pa.list_(pa.string()),
+    'tags_values': pa.list_(pa.string()),
+    'road_type': pa.dictionary(pa.int32(), pa.string()),
+    'country': pa.dictionary(pa.int32(), pa.string()),
+    'state': pa.dictionary(pa.int32(), pa.string()),
+    'visible': pa.bool_(),
+}
+
+
+# the day's file, the old gzip pickle if the day was collected before the parquet files
+def changes_file(day, folder=CHANGES_FOLDER):
+    file = f'{folder}/{day}.parquet'
+    legacy_file = f'{folder}/{day}.pkl.gzip'
+    if not os.path.exists(file) and os.path.exists(legacy_file):
+        return legacy_file
+    return file
+
+
+def to_arrow(column, type):
+    if pa.types.is_list(type):
+        lengths = np.fromiter((len(values) for values in column), dtype=np.int32, count=len(column))
+        offsets = np.zeros(len(column) + 1, dtype=np.int32)
+        np.cumsum(lengths, out=offsets[1:])
+        values = pa.array(list(chain.from_iterable(column)), type=type.value_type)
+        return pa.ListArray.from_arrays(pa.array(offsets), values)
+    if pa.types.is_timestamp(type):
+        column = pd.to_datetime(column, format='%Y-%m-%dT%H:%M:%SZ', utc=True)
+    elif pa.types.is_boolean(type) and column.dtype == object:
+        column = column.map({'true': True, 'false': False, True: True, False: False})
+    elif pa.types.is_dictionary(type):
+        return pa.DictionaryArray.from_pandas(pd.Categorical(column.astype(object))).cast(type)
+    return pa.array(column, type=type, from_pandas=True)
+
+
+def write_changes_file(df, file):
+    columns = {}
+    for name in df.columns:
+        type = CHANGES_SCHEMA.get(name, pa.dictionary(pa.int32(), pa.string()))
+        columns[name] = to_arrow(df[name], type)
+    table = pa.table(columns)
+    tmp = f'{file}.{os.getpid()}.tmp'
+    pq.write_table(table, tmp, compression='zstd')
+    os.replace(tmp, file)
+
+
+# column names of a day's parquet file (from its footer), None for an old gzip pickle which can't be
+# inspected without reading it whole
+def changes_file_columns(file):
+    if file.endswith('.pkl.gzip'):
+        return None
+    return pq.read_schema(file).names
+
+
+# reads a day's changes (parquet, or an old gzip pickle), only the given columns that exist in the file
+def read_changes_file(file, columns=None):
+    if file.endswith('.pkl.gzip'):
+        df = pd.read_pickle(file, compression='gzip')
+        return df if columns is None else df[[c for c in columns if c in df]]
+    if columns is not None:
+        names = pq.read_schema(file).names
+        columns = [c for c in columns if c in names]
+    return pq.read_table(file, columns=columns).to_pandas()
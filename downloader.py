@@ -0,0 +1,154 @@
+#%%
+import asyncio
+import fcntl
+import glob
+import gzip
+import os
+import shutil
+import zlib
+
+import aiohttp
+
+
+
+class DownloadValidationError(Exception):
+    pass
+
+
+# raised when files that must exist (e.g. a day's diff) are not published on the server
+class MissingFilesError(Exception):
+    pass
+
+
+# verifies the gzip CRC32 and length trailer of a downloaded replication file
+def verify_gzip(file):
+    with gzip.open(file, 'rb') as f:
+        while f.read(1 << 20):
+            pass
+
+
+# asyncio based downloader for replication files. All requests go through one pooled keep-alive
+# connector with at most `concurrency` connections in flight. Each file is streamed to a temporary
+# file, validated (size against Content-Length, gzip checksum) and atomically renamed into place,
+# so a file either exists complete or doesn't exist at all.
+class AsyncDownloader:
+    RETRY_STATUSES = {500, 502, 503, 504}
+
+    def __init__(self, concurrency=16, retries=50, backoff_factor=0.1, max_backoff=30, timeout=300, chunk_size=1 << 16):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    # urls_files: list of (url, file). Returns the urls that don't exist on the server (404),
+    # raises if any other file could not be downloaded after all retries.
+    def download_all(self, urls_files):
+        return asyncio.run(self._download_all(urls_files))
+
+    async def _download_all(self, urls_files):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+            results = await asyncio.gather(*[self._download(session, url, file) for url, file in urls_files])
+        return [url for url in results if url is not None]
+
+    async def _download(self, session, url, file):
+        if os.path.exists(file):
+            return None
+
+        tmp = f'{file}.{os.getpid()}.part'
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(url) as response:
+                    if response.status == 404:
+                        return url
+                    if response.status in self.RETRY_STATUSES:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+                    response.raise_for_status()
+
+                    size = 0
+                    with open(tmp, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            f.write(chunk)
+                            size += len(chunk)
+
+                    if response.content_length is not None and size != response.content_length:
+                        raise DownloadValidationError(f'{url}: expected {response.content_length} bytes, got {size}')
+
+                if url.endswith('.gz'):
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(None, verify_gzip, tmp)
+                    except (OSError, EOFError, zlib.error) as e:
+                        raise DownloadValidationError(f'{url}: {e}')
+
+                os.replace(tmp, file)
+                return None
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadValidationError):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(min(self.backoff_factor * (2 ** attempt), self.max_backoff))
+
+
+
+# On-disk cache of replication files shared by all the day workers. Replication files never change once
+# published, so a file is identified by its stream and sequence number. Day folders get hard links to the
+# cached files (their data stays until the day is cleared even if evicted meanwhile). Recency is kept in
+# the files' mtime, and the least recently used files are evicted when the cache grows over max_bytes.
+class DownloadCache:
+    def __init__(self, folder='download_cache', max_bytes=50 * 2**30):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def path(self, stream, sequence, suffix):
+        folder = f'{self.folder}/{stream}'
+        os.makedirs(folder, exist_ok=True)
+        return f'{folder}/{sequence}{suffix}'
+
+    # links a cached file into target and marks it as recently used. Returns False if it's not cached.
+    def link(self, cached, target):
+        try:
+            os.utime(cached)
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(cached, target)
+            except OSError:
+                shutil.copyfile(cached, target)
+            return True
+        except FileNotFoundError:
+            return False
+
+    # removes least recently used files until the cache fits in max_bytes. Only one worker evicts at a time,
+    # the others skip. Files may disappear under us (another worker, or a concurrent clear), that's fine.
+    def evict(self):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(f'{self.folder}/.evict.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            files = []
+            for entry in glob.glob(f'{self.folder}/*/*'):
+                if entry.endswith('.part'):
+                    continue
+                try:
+                    stat = os.stat(entry)
+                    files.append((stat.st_mtime, stat.st_size, entry))
+                except FileNotFoundError:
+                    pass
+
+            total = sum(size for _, size, _ in files)
+            for _, size, entry in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
+                total -= size
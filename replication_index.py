@@ -0,0 +1,133 @@
+#%%
+import fcntl
+import json
+import os
+import re
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+# parses a replication state file, both the changesets format (yaml: last_run / sequence)
+# and the diffs format (java properties: timestamp / sequenceNumber). Returns (sequence, timestamp).
+def parse_state(text):
+    sequence = re.search(r'^(?:sequence|sequenceNumber)\s*[:=]\s*(\d+)', text, re.MULTILINE)
+    last_run = re.search(r'^last_run:\s*(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)', text, re.MULTILINE)
+    timestamp = re.search(r'^timestamp=(\d{4}-\d\d-\d\dT\d\d\\?:\d\d\\?:\d\d)Z', text, re.MULTILINE)
+    if last_run:
+        time = datetime.strptime(last_run.group(1), '%Y-%m-%d %H:%M:%S')
+    elif timestamp:
+        time = datetime.strptime(timestamp.group(1).replace('\\', ''), '%Y-%m-%dT%H:%M:%S')
+    else:
+        raise ValueError('Not a replication state file')
+    return int(sequence.group(1)) if sequence else None, time.replace(tzinfo=timezone.utc)
+
+
+
+# Local sequence number -> timestamp index of a replication stream (e.g. changesets), built from the
+# per-sequence state.txt files. Sequence ranges for a time window are found by searching the index,
+# only fetching the state files of the probed sequences that are not known yet, and every fetched
+# state is added to the index file. Consecutive days reuse the probes of the previous ones,
+# so after the first run a day costs a handful of small requests and no directory listing.
+class ReplicationSequenceIndex:
+    # the top level state of the changesets stream is state.yaml, the diffs streams use state.txt
+    TOP_LEVEL_STATE = {'changesets': 'state.yaml'}
+
+    def __init__(self, session, replication_url, stream='changesets', index_folder='data/replication_index'):
+        self.session = session
+        self.stream_url = f'{replication_url}/{stream}'
+        self.top_level_state = self.TOP_LEVEL_STATE.get(stream, 'state.txt')
+        self.index_file = f'{index_folder}/{stream}.json'
+        self.index = {}
+        self.new_entries = {}
+        if os.path.exists(self.index_file):
+            self.index = {int(seq): datetime.fromisoformat(ts) for seq, ts in json.load(open(self.index_file)).items()}
+
+    def fetch_state(self, url):
+        response = self.session.get(url)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return parse_state(response.text)
+
+    def current(self):
+        sequence, time = self.fetch_state(f'{self.stream_url}/{self.top_level_state}')
+        self.add(sequence, time)
+        return sequence, time
+
+    def add(self, sequence, time):
+        self.index[sequence] = time
+        self.new_entries[sequence] = time
+
+    def timestamp(self, sequence):
+        if sequence not in self.index:
+            path = f'{sequence:011,}'.replace(',', '/')
+            state = self.fetch_state(f'{self.stream_url}/{path}.state.txt')
+            if state is None:
+                return None
+            self.add(sequence, state[1])
+        return self.index[sequence]
+
+    # smallest sequence in (lo, hi] whose timestamp is >= time, given timestamp(lo) < time <= timestamp(hi).
+    # Probes are interpolated from the timestamps of the bounds (one sequence per minute for changesets),
+    # which usually converges in 2-3 state requests, with a bisection step whenever the guess is not useful.
+    def search(self, time, lo, hi):
+        while hi - lo > 1:
+            t_lo, t_hi = self.index[lo], self.index[hi]
+            guess = lo + int((hi - lo) * (time - t_lo).total_seconds() / (t_hi - t_lo).total_seconds())
+            guess = min(max(guess, lo + 1), hi - 1)
+            probe = self.timestamp(guess)
+            if probe is None:
+                # missing state file, fall back to bisection around it
+                guess = (lo + hi) // 2
+                probe = self.timestamp(guess)
+                if probe is None:
+                    return hi
+            if probe >= time:
+                hi = guess
+            else:
+                lo = guess
+        return hi
+
+    # first sequence covering `time`, bracketing the search with the closest known sequences. When no known
+    # sequence is older than `time`, one is found by stepping back from the bracket's upper bound
+    # (first step assumes one sequence per minute, doubled until a sequence older than `time` is found).
+    def first_sequence_at(self, time, current):
+        lo = max([seq for seq, t in self.index.items() if t < time], default=None)
+        hi = min([seq for seq, t in self.index.items() if t >= time and seq <= current], default=current)
+        if lo is None:
+            step = max(int((self.index[hi] - time).total_seconds() // 60), 1)
+            while True:
+                lo = max(hi - step, 0)
+                lo_time = self.timestamp(lo)
+                if lo_time is not None and lo_time < time:
+                    break
+                if lo == 0:
+                    return 0
+                step *= 2
+        return self.search(time, lo, hi)
+
+    # exact range of sequence files that cover the [start, end) time window
+    def sequence_range(self, start, end):
+        current, current_time = self.current()
+        if start > current_time:
+            raise RuntimeError('No OSM diff files for this date yet.')
+
+        first = self.first_sequence_at(start, current)
+        last = current if end > current_time else self.first_sequence_at(end, current)
+        self.save()
+        return range(first, last + 1)
+
+    # merges the newly fetched states into the index file. Several day workers may update it at the
+    # same time, so what's on disk is re-read and replaced under a file lock (and atomically for readers).
+    def save(self):
+        if not self.new_entries:
+            return
+        Path(self.index_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(f'{self.index_file}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            on_disk = json.load(open(self.index_file)) if os.path.exists(self.index_file) else {}
+            on_disk.update({str(seq): time.isoformat() for seq, time in self.new_entries.items()})
+            tmp = f'{self.index_file}.{os.getpid()}.tmp'
+            json.dump(on_disk, open(tmp, 'w'))
+            os.replace(tmp, self.index_file)
+        self.new_entries = {}
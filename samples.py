@@ -0,0 +1,94 @@
+#%%
+import geopandas
+import pandas as pd
+from sqlalchemy import text
+
+from db import get_engine
+
+
+ELEMENTS = ['node', 'way', 'relation']
+# changeset_ids only has flags for these operations (deletes are not loaded)
+OPERATIONS = ['create', 'modify']
+
+
+# the queries below rely on the indexes the loader creates on changeset_ids (db.CHANGESET_IDS_INDEXES)
+
+
+# where clause and bound parameters of a sample query. List filters are passed as arrays (= ANY(:param)),
+# so the statement is the same whatever the number of countries, and None means no filter.
+def sample_filters(start, end, elements, operations, road_types=None, countries=None, states=None):
+    conditions = ['day BETWEEN :start AND :end']
+    params = {'start': start, 'end': end}
+
+    # element/operation names are only used as column names when they are known flags
+    elements = [e for e in elements if e in ELEMENTS]
+    operations = [o for o in operations if o in OPERATIONS]
+    conditions.append('(' + (' OR '.join(f'element_{e}' for e in elements) or 'FALSE') + ')')
+    conditions.append('(' + (' OR '.join(f'operation_{o}' for o in operations) or 'FALSE') + ')')
+
+    for column, param, values in [('road_type', 'road_types', road_types), ('country', 'countries', countries), ('state', 'states', states)]:
+        if values is not None:
+            conditions.append(f'{column} = ANY(:{param})')
+            params[param] = list(values)
+
+    return ' AND '.join(conditions), params
+
+
+# Spatially stratified sample of the changesets inside bounds ((south, west), (north, east), as given by leaflet):
+# the viewport is split into a grid of `cells` x `cells` and one changeset is taken per cell. Every cell is a
+# separate LIMIT 1 probe of the GiST index on geometry, so the cost depends on the number of cells and not on
+# the number of changesets in the viewport, and dense areas don't crowd out the rest of the map.
+def sample_changesets_in_bounds(bounds, start, end, elements, operations, road_types=None, countries=None, states=None, cells=16):
+    (south, west), (north, east) = bounds
+    south, north = max(south, -90), min(north, 90)
+    west, east = max(west, -180), min(east, 180)
+
+    where, params = sample_filters(start, end, elements, operations, road_types, countries, states)
+    params.update({
+        'west': west, 'south': south, 'cells': cells,
+        'width': (east - west) / cells, 'height': (north - south) / cells,
+    })
+    sql = text(f"""
+        SELECT sample.* FROM generate_series(0, :cells - 1) AS x
+        CROSS JOIN generate_series(0, :cells - 1) AS y
+        CROSS JOIN LATERAL (
+            SELECT * FROM changeset_ids
+            WHERE geometry && ST_MakeEnvelope(
+                :west + x * :width, :south + y * :height,
+                :west + (x + 1) * :width, :south + (y + 1) * :height, 4326)
+            AND {where}
+            LIMIT 1
+        ) AS sample""")
+    with get_engine().connect() as connection:
+        changes = geopandas.read_postgis(sql, connection, geom_col='geometry', params=params)
+    return changes.drop_duplicates(subset=['changeset'])
+
+
+
+# number of clusters per side of a 256px map tile, i.e. one cluster per ~64px square on screen
+CLUSTER_CELLS_PER_TILE = 4
+
+
+# Changesets inside bounds aggregated on the server into clusters: points are snapped to a grid whose cell size
+# follows the zoom level (a fixed size on screen), and each cell returns the number of distinct changesets and
+# their centroid. The result is bounded by the number of cells of the viewport whatever the number of changesets.
+def cluster_changesets_in_bounds(bounds, zoom, start, end, elements, operations, road_types=None, countries=None, states=None):
+    (south, west), (north, east) = bounds
+    south, north = max(south, -90), min(north, 90)
+    west, east = max(west, -180), min(east, 180)
+
+    where, params = sample_filters(start, end, elements, operations, road_types, countries, states)
+    params.update({
+        'west': west, 'south': south, 'east': east, 'north': north,
+        'size': 360 / (2 ** zoom * CLUSTER_CELLS_PER_TILE),
+    })
+    sql = text(f"""
+        SELECT count(DISTINCT changeset) AS count,
+            ST_Y(ST_Centroid(ST_Collect(geometry))) AS lat,
+            ST_X(ST_Centroid(ST_Collect(geometry))) AS lon
+        FROM changeset_ids
+        WHERE geometry && ST_MakeEnvelope(:west, :south, :east, :north, 4326)
+        AND {where}
+        GROUP BY ST_SnapToGrid(geometry, :size)""")
+    with get_engine().connect() as connection:
+        return pd.read_sql(sql, connection, params=params)
@@ -0,0 +1,180 @@
+#%%
+import fcntl
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import geopandas
+from geopandas.tools import sjoin
+from shapely.geometry import box
+
+
+# builds the point geometry array of a DataFrame straight from its lon/lat columns
+# (vectorized, no Python call per row).
+def points_from_lonlat(df, lon='lon', lat='lat'):
+    return geopandas.points_from_xy(df[lon].values, df[lat].values, crs=4326)
+
+
+
+COUNTRIES_FILE = 'misc/UIA_World_Countries_Boundaries_with_ISO3/World_Countries__Generalized_.shp'
+US_STATES_FILE = 'misc/us-states.json'
+BOUNDARY_INDEX_FILE = 'misc/boundary_index.pkl'
+GRID_RESOLUTION = 0.25
+# bump when the pickled layout of the index changes
+BOUNDARY_INDEX_FORMAT = 2
+
+
+# a single layer holding both the country boundaries and the U.S. states, used to tag points with
+# their country and state in one spatial join. Country rows have state=None and state rows have
+# country=None. The layer is prebuilt once to BOUNDARY_INDEX_FILE and loaded at most once per process.
+#
+# On top of the layer, a fixed resolution lat/lon grid resolves most points by array lookup: a cell
+# that lies fully inside a single country (and a single state for the U.S.) maps to that label, a cell
+# touching no boundary maps to nothing, and only points in the remaining (border) cells go through the
+# exact polygon test.
+class BoundaryIndex:
+    _loaded = None
+    OUTSIDE = -1
+    BORDER = -2
+
+    def __init__(self, boundaries, resolution, grid, labels):
+        self.boundaries = boundaries
+        self.boundaries.sindex
+        self.resolution = resolution
+        self.grid = grid
+        self.labels = labels
+
+    @classmethod
+    def build(cls, resolution=GRID_RESOLUTION):
+        countries = geopandas.read_file(COUNTRIES_FILE)
+        countries = geopandas.GeoDataFrame({'country': countries.COUNTRYAFF, 'state': None}, geometry=countries.geometry)
+        states = geopandas.read_file(US_STATES_FILE)
+        states = geopandas.GeoDataFrame({'country': None, 'state': states.name}, geometry=states.geometry)
+        boundaries = pd.concat([countries, states], ignore_index=True)
+        boundaries = geopandas.GeoDataFrame(boundaries, geometry='geometry', crs=4326)
+        grid, labels = cls.build_grid(boundaries, resolution)
+        return cls(boundaries, resolution, grid, labels)
+
+    @classmethod
+    def build_grid(cls, boundaries, resolution):
+        n_rows, n_cols = int(180 / resolution), int(360 / resolution)
+        rows, cols = np.divmod(np.arange(n_rows * n_cols), n_cols)
+        # cells are slightly enlarged, so a point on a cell edge is covered by whichever cell it is assigned to
+        eps = resolution * 1e-6
+        cells = geopandas.GeoDataFrame(geometry=[
+            box(-180 + c * resolution - eps, -90 + r * resolution - eps, -180 + (c + 1) * resolution + eps, -90 + (r + 1) * resolution + eps)
+            for r, c in zip(rows, cols)
+        ], crs=4326)
+
+        hits = sjoin(cells, boundaries, how='inner', predicate='intersects')[['index_right']]
+        inside = sjoin(cells, boundaries, how='inner', predicate='within')[['index_right']]
+        hits['within'] = pd.MultiIndex.from_arrays([hits.index, hits.index_right]).isin(
+            pd.MultiIndex.from_arrays([inside.index, inside.index_right]))
+        hits['country'] = boundaries.country.values[hits.index_right]
+        hits['state'] = boundaries.state.values[hits.index_right]
+
+        per_cell = hits.groupby(level=0).agg(
+            within=('within', 'all'),
+            countries=('country', 'count'),
+            states=('state', 'count'),
+            country=('country', 'first'),
+            state=('state', 'first'),
+        )
+        interior = per_cell[per_cell.within & (per_cell.countries == 1) & (per_cell.states <= 1)]
+        state = interior.state.where(interior.country == 'United States').fillna(interior.country)
+        codes, labels = pd.factorize(pd.MultiIndex.from_arrays([interior.country, state]))
+
+        grid = np.full(n_rows * n_cols, cls.OUTSIDE, dtype=np.int32)
+        grid[per_cell.index.values] = cls.BORDER
+        grid[interior.index.values] = codes
+        return grid.reshape(n_rows, n_cols), list(labels)
+
+    # the pickled index, None if it is missing, older than the sources or built with another resolution/format
+    @classmethod
+    def read(cls, resolution=GRID_RESOLUTION):
+        sources_mtime = max(os.path.getmtime(f) for f in [COUNTRIES_FILE, US_STATES_FILE])
+        if not os.path.exists(BOUNDARY_INDEX_FILE) or os.path.getmtime(BOUNDARY_INDEX_FILE) < sources_mtime:
+            return None
+        saved = pickle.load(open(BOUNDARY_INDEX_FILE, 'rb'))
+        if not isinstance(saved, dict) or saved.get('format') != BOUNDARY_INDEX_FORMAT or saved['resolution'] != resolution:
+            return None
+        return cls(saved['boundaries'], saved['resolution'], saved['grid'], saved['labels'])
+
+    # loads (or builds) the index once per process. The job loads it before starting the day workers, which
+    # inherit it; otherwise the build runs under a file lock, so only one process builds it and the others
+    # wait and read the result.
+    @classmethod
+    def load(cls):
+        if cls._loaded is not None:
+            return cls._loaded
+
+        index = cls.read()
+        if index is None:
+            with open(f'{BOUNDARY_INDEX_FILE}.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                index = cls.read()
+                if index is None:
+                    index = cls.build()
+                    tmp = f'{BOUNDARY_INDEX_FILE}.{os.getpid()}.tmp'
+                    pickle.dump({
+                        'format': BOUNDARY_INDEX_FORMAT,
+                        'boundaries': index.boundaries,
+                        'resolution': index.resolution,
+                        'grid': index.grid,
+                        'labels': index.labels,
+                    }, open(tmp, 'wb'))
+                    os.replace(tmp, BOUNDARY_INDEX_FILE)
+
+        cls._loaded = index
+        return index
+
+    # returns (country, state) Series aligned with points_gdf. state is only looked up for points in the
+    # United States and falls back to the country otherwise, both are NaN for points outside every country.
+    def lookup(self, points_gdf):
+        n_rows, n_cols = self.grid.shape
+        x = points_gdf.geometry.x.values
+        y = points_gdf.geometry.y.values
+        with np.errstate(invalid='ignore'):
+            cols = np.floor((x + 180) / self.resolution)
+            rows = np.floor((y + 90) / self.resolution)
+
+        cells = np.full(len(points_gdf), self.BORDER, dtype=np.int32)
+        valid = ~(np.isnan(cols) | np.isnan(rows))
+        cells[valid] = self.grid[
+            np.clip(rows[valid], 0, n_rows - 1).astype(np.int64),
+            np.clip(cols[valid], 0, n_cols - 1).astype(np.int64)
+        ]
+
+        # OUTSIDE (-1) picks the trailing NaN label, BORDER rows are overwritten below
+        label_countries = np.array([country for country, _ in self.labels] + [np.nan], dtype=object)
+        label_states = np.array([state for _, state in self.labels] + [np.nan], dtype=object)
+        country = pd.Series(label_countries[cells], index=points_gdf.index)
+        state = pd.Series(label_states[cells], index=points_gdf.index)
+
+        border = cells == self.BORDER
+        if border.any():
+            border_country, border_state = self.lookup_exact(points_gdf[border])
+            country[border] = border_country.values
+            state[border] = border_state.values
+
+        return country, state
+
+    def lookup_exact(self, points_gdf):
+        joined = sjoin(points_gdf[['geometry']], self.boundaries, how='left')
+        matches = joined[['country', 'state']].groupby(level=0).first().reindex(points_gdf.index)
+        country = matches['country']
+        state = matches['state'].where(country == 'United States').fillna(country)
+        return country, state
+
+
+
+# hex encoded EWKB points (what PostGIS accepts as text input for geometry columns, e.g. in COPY),
+# packed for all the rows at once with a numpy record array instead of one geometry object per row.
+def points_to_ewkb_hex(lon, lat, srid=4326):
+    records = np.empty(len(lon), dtype=[('order', 'u1'), ('type', '<u4'), ('srid', '<u4'), ('x', '<f8'), ('y', '<f8')])
+    records['order'] = 1             # little endian
+    records['type'] = 0x20000001     # point, with srid flag
+    records['srid'] = srid
+    records['x'] = lon
+    records['y'] = lat
+    return np.frombuffer(records.tobytes().hex().encode(), dtype=f'S{2 * records.itemsize}').astype(str)
@@ -0,0 +1,475 @@
+#%%
+import fcntl
+from collections import OrderedDict
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+
+
+AGGREGATES_FOLDER = 'data/changes_aggregated'
+INDEX_LEVELS = ['day', 'road_type']
+COLUMN_LEVELS = ['country', 'state', 'element', 'operation']
+
+
+# the aggregated frames are wide: index (day, road_type) and columns (country, state, element, operation),
+# NaN for absent combinations. Partitions are stored long, one row per non empty count.
+def to_long(wide_df):
+    values = wide_df.values
+    with np.errstate(invalid='ignore'):
+        rows, cols = np.nonzero(~np.isnan(values) & (values != 0))
+
+    long_df = pd.DataFrame({
+        level: np.asarray(wide_df.index.get_level_values(i))[rows] for i, level in enumerate(INDEX_LEVELS)
+    })
+    for i, level in enumerate(COLUMN_LEVELS):
+        long_df[level] = np.asarray(wide_df.columns.get_level_values(i))[cols]
+    long_df['count'] = values[rows, cols].astype(np.int64)
+
+    for level in INDEX_LEVELS + COLUMN_LEVELS:
+        long_df[level] = long_df[level].astype(str).astype('category')
+    return long_df
+
+
+
+# Append-only store of the daily aggregates: one parquet partition per day plus a manifest listing the
+# partitions. A writer only writes its own day and then registers it in the manifest (a short critical
+# section under a file lock), instead of rewriting the whole history. Partitions and the manifest are
+# written to temp files and renamed, so a reader that loads the manifest first always sees a consistent
+# snapshot of complete partitions.
+# The whole history is also kept as one uncompressed Arrow IPC file (write_history), which readers memory map:
+# loading it doesn't decompress anything and its pages are shared by all the processes through the page cache.
+# Only the days whose partition changed since the history file was written are read from the partitions.
+# The DayPrefixIndex of the history is written next to it (history_prefix.arrow, history_series.arrow) and
+# memory mapped the same way, as long as no partition changed since.
+class AggregateStore:
+    def __init__(self, folder=AGGREGATES_FOLDER):
+        self.folder = folder
+        self.partitions_folder = f'{folder}/partitions'
+        self.manifest_file = f'{folder}/manifest.json'
+        self.legacy_file = f'{folder}/all.pkl.gzip'
+        self.history_file = f'{folder}/history.arrow'
+        self.prefix_file = f'{folder}/history_prefix.arrow'
+        self.prefix_series_file = f'{folder}/history_series.arrow'
+
+    def manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return {'version': 0, 'partitions': {}}
+        return json.load(open(self.manifest_file))
+
+    def write_partition(self, day, wide_df):
+        self.write_partitions({day: to_long(wide_df)})
+
+    # long_dfs: {day: long DataFrame}
+    def write_partitions(self, long_dfs):
+        Path(self.partitions_folder).mkdir(parents=True, exist_ok=True)
+        files = {}
+        for day, long_df in long_dfs.items():
+            file = f'{day}.parquet'
+            tmp = f'{self.partitions_folder}/{file}.{os.getpid()}.tmp'
+            long_df.to_parquet(tmp, index=False)
+            os.replace(tmp, f'{self.partitions_folder}/{file}')
+            files[day] = file
+
+        with open(f'{self.folder}/.manifest.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.manifest()
+            manifest['partitions'].update(files)
+            manifest['partitions'] = dict(sorted(manifest['partitions'].items()))
+            manifest['version'] += 1
+            tmp = f'{self.manifest_file}.{os.getpid()}.tmp'
+            json.dump(manifest, open(tmp, 'w'))
+            os.replace(tmp, self.manifest_file)
+
+    # long rows of every partition listed in the manifest (or the given snapshot of it)
+    def load(self, manifest=None):
+        manifest = manifest or self.manifest()
+        history, fresh_days = self.load_history(manifest)
+        files = [f'{self.partitions_folder}/{file}' for day, file in manifest['partitions'].items() if day not in fresh_days]
+        if history is not None and not files:
+            return history
+
+        parts = ([history] if history is not None else []) + [pd.read_parquet(f) for f in files]
+        if not parts:
+            long_df = pd.DataFrame({level: pd.Categorical([]) for level in INDEX_LEVELS + COLUMN_LEVELS})
+            long_df['count'] = np.array([], dtype=np.int64)
+            return long_df
+        long_df = pd.DataFrame({
+            level: union_categoricals([part[level].astype('category') for part in parts])
+            for level in INDEX_LEVELS + COLUMN_LEVELS
+        })
+        long_df['count'] = np.concatenate([part['count'].values for part in parts])
+        return long_df
+
+    def partition_mtimes(self, manifest):
+        return {day: os.stat(f'{self.partitions_folder}/{file}').st_mtime_ns for day, file in manifest['partitions'].items()}
+
+    # memory maps the history file. Returns its rows of the manifest's days that are up to date in it
+    # (partition unchanged since it was written), and these days.
+    def load_history(self, manifest):
+        if not os.path.exists(self.history_file):
+            return None, set()
+        table = self.read_arrow(self.history_file)
+        written = json.loads(table.schema.metadata[b'partitions'])
+        current = self.partition_mtimes(manifest)
+        fresh_days = {day for day, mtime in written.items() if current.get(day) == mtime}
+        if not fresh_days:
+            return None, set()
+
+        history = table.to_pandas(split_blocks=True)
+        if len(fresh_days) < len(written):
+            history = history[history['day'].isin(fresh_days)].reset_index(drop=True)
+        return history, fresh_days
+
+    # memory mapped Arrow IPC file
+    def read_arrow(self, file):
+        return pa.ipc.open_file(pa.memory_map(file)).read_all()
+
+    # writes an uncompressed Arrow IPC file (through a temp file), tagging it with the partitions it was built from
+    def write_arrow(self, table, file, mtimes, **metadata):
+        metadata = {**(table.schema.metadata or {}), b'partitions': json.dumps(mtimes).encode(),
+                    **{name.encode(): json.dumps(value).encode() for name, value in metadata.items()}}
+        table = table.replace_schema_metadata(metadata)
+        tmp = f'{file}.{os.getpid()}.tmp'
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, file)
+
+    # rewrites the history file (and its prefix index) from the current partitions, sorted by day so that
+    # a range of days is a contiguous range of pages
+    def write_history(self):
+        manifest = self.manifest()
+        if not manifest['partitions']:
+            return
+        mtimes = self.partition_mtimes(manifest)
+        long_df = self.load(manifest)
+        long_df['day'] = long_df['day'].cat.reorder_categories(sorted(long_df['day'].cat.categories))
+        long_df = long_df.sort_values('day', kind='stable').reset_index(drop=True)
+
+        DayPrefixIndex.build(AggregateCube(long_df)).write(self, mtimes)
+        self.write_arrow(pa.Table.from_pandas(long_df, preserve_index=False), self.history_file, mtimes)
+
+    # one time migration of the old single pickle into day partitions
+    def import_legacy(self):
+        if self.manifest()['partitions'] or not os.path.exists(self.legacy_file):
+            return
+        wide_df = pd.read_pickle(self.legacy_file, compression='gzip')
+        self.write_partitions({day: to_long(day_df) for day, day_df in wide_df.groupby(level='day')})
+
+
+
+# Query API over the long aggregates (day, road_type, country, state, element, operation, count).
+# Dimensions are dictionary encoded (categoricals), so filters are evaluated once per distinct
+# value and then mapped through the codes, and groupbys run row-wise on the codes.
+class AggregateCube:
+    DIMENSIONS = INDEX_LEVELS + COLUMN_LEVELS
+
+    def __init__(self, long_df):
+        self.df = long_df
+
+    @classmethod
+    def from_store(cls, store=None, manifest=None):
+        return cls((store or AggregateStore()).load(manifest))
+
+    def __len__(self):
+        return len(self.df)
+
+    def values(self, dimension):
+        column = self.df[dimension]
+        return column.cat.categories[np.unique(column.cat.codes)].tolist()
+
+    # mask of the rows whose `dimension` value satisfies `keep`, keep being evaluated on the categories only
+    def mask(self, dimension, keep):
+        column = self.df[dimension]
+        keep = np.append(np.asarray(keep(column.cat.categories), dtype=bool), False)
+        return keep[column.cat.codes.values]
+
+    # filters: start/end (inclusive days), and lists of accepted values for any dimension (None for all).
+    # group_by: dimensions to keep, counts are summed over the others. Returns a long DataFrame.
+    def query(self, start=None, end=None, group_by=None, **filters):
+        mask = np.ones(len(self.df), dtype=bool)
+        if start is not None or end is not None:
+            start, end = start or '', end or '9999-99-99'
+            mask &= self.mask('day', lambda days: (days >= start) & (days <= end))
+        for dimension, values in filters.items():
+            if values is not None:
+                mask &= self.mask(dimension, lambda categories: categories.isin(list(values)))
+
+        df = self.df[mask]
+        if group_by is None:
+            return df
+        grouped = df.groupby(list(group_by), observed=True, sort=True)['count'].sum().reset_index()
+        return grouped
+
+    # query grouped by index + columns dimensions and pivoted to a wide frame (absent combinations are NaN)
+    def pivot(self, index, columns, start=None, end=None, **filters):
+        grouped = self.query(start, end, group_by=list(index) + list(columns), **filters)
+        if not len(grouped):
+            return pd.DataFrame(
+                index=pd.MultiIndex(levels=[[]] * len(index), codes=[[]] * len(index), names=list(index)),
+                columns=pd.MultiIndex(levels=[[]] * len(columns), codes=[[]] * len(columns), names=list(columns)))
+        grouped = grouped.astype({dimension: object for dimension in list(index) + list(columns)})
+        return grouped.set_index(list(index) + list(columns))['count'].astype(float).unstack(list(columns))
+
+
+
+# Cumulative counts along the day axis for every series (road_type, country, state, element, operation) of a
+# cube, so the total of any date range is two lookups and a subtraction per series instead of a sum over the
+# rows of every day in the range. Rows are sorted by (series, day) and the running sum is taken over all of
+# them; a series' range total is the difference of the running sum at the range bounds within its segment.
+# The store persists the index of its history file (write), and the dashboard memory maps it (read) instead of
+# sorting the whole history again in every process.
+class DayPrefixIndex:
+    SERIES = [d for d in AggregateCube.DIMENSIONS if d != 'day']
+
+    # days: sorted days, series: one row per series, keys: sorted (series, day rank) keys of the rows,
+    # cumsum: running sum of the counts in key order (inclusive)
+    def __init__(self, days, series, keys, cumsum):
+        self.days = days
+        self.series = series
+        self.keys = keys
+        self.cumsum = cumsum
+
+    @classmethod
+    def build(cls, cube):
+        df = cube.df
+        days = np.sort(np.asarray(df['day'].cat.categories, dtype=object))
+        day_rank = np.searchsorted(days, np.asarray(df['day'].cat.categories, dtype=object))
+
+        series = df.groupby(cls.SERIES, observed=True, sort=False).ngroup().values
+        first = np.unique(series, return_index=True)[1]
+
+        keys = series.astype(np.int64) * len(days) + day_rank[df['day'].cat.codes.values]
+        order = np.argsort(keys, kind='stable')
+        return cls(days, df[cls.SERIES].iloc[first].reset_index(drop=True), keys[order],
+                   np.cumsum(df['count'].values[order], dtype=np.int64))
+
+    # writes the arrays next to the store's history file, tagged with the partition mtimes they were built from
+    def write(self, store, mtimes):
+        store.write_arrow(pa.table({'key': self.keys, 'cumsum': self.cumsum}), store.prefix_file, mtimes, days=list(self.days))
+        store.write_arrow(pa.Table.from_pandas(self.series, preserve_index=False), store.prefix_series_file, mtimes)
+
+    # memory maps the persisted index, None if it is missing or not built from the manifest's current partitions
+    @classmethod
+    def read(cls, store, manifest):
+        if not (os.path.exists(store.prefix_file) and os.path.exists(store.prefix_series_file)):
+            return None
+        current = store.partition_mtimes(manifest)
+        prefix, series = store.read_arrow(store.prefix_file), store.read_arrow(store.prefix_series_file)
+        if any(json.loads(table.schema.metadata[b'partitions']) != current for table in [prefix, series]):
+            return None
+        days = np.array(json.loads(prefix.schema.metadata[b'days']), dtype=object)
+        return cls(days, series.to_pandas(), prefix['key'].to_numpy(), prefix['cumsum'].to_numpy())
+
+    # running sum of the counts of the rows before the given positions
+    def sum_before(self, positions):
+        sums = np.zeros(len(positions), dtype=np.int64)
+        after_first = positions > 0
+        sums[after_first] = self.cumsum[positions[after_first] - 1]
+        return sums
+
+    # totals of [start, end] (inclusive days) per series, long rows like AggregateCube.query(group_by=SERIES)
+    def range_totals(self, start=None, end=None, **filters):
+        first = np.searchsorted(self.days, start or '', 'left')
+        last = np.searchsorted(self.days, end or '9999-99-99', 'right')
+
+        mask = np.ones(len(self.series), dtype=bool)
+        for dimension, values in filters.items():
+            if values is not None:
+                mask &= AggregateCube(self.series).mask(dimension, lambda categories: categories.isin(list(values)))
+        ids = np.nonzero(mask)[0].astype(np.int64) * len(self.days)
+
+        counts = (self.sum_before(np.searchsorted(self.keys, ids + last, 'left'))
+                  - self.sum_before(np.searchsorted(self.keys, ids + first, 'left')))
+        totals = self.series[mask].reset_index(drop=True)
+        totals['count'] = counts
+        return totals[counts != 0].reset_index(drop=True)
+
+
+
+TOTALS_FILE = 'data/total_per_country.pkl.gzip'
+TOTALS_STATE_FILE = 'data/total_per_country.json'
+
+
+# Denominators of the percentage views: number of elements per road type (rows) and (country, state, element)
+# (columns). They are maintained from the day partitions, each day not applied yet adds its creates. Deletes
+# can't be subtracted: deleted elements carry no tags in the replication diffs, so they have no road type (and
+# deleted ways no location) and never reach the partitions. The totals are therefore an upper bound of the
+# existing elements (the baseline file, plus every element created since), and the percentages a lower bound.
+# The state file lists the applied days, so days landing out of order (or left over
+# from a failed run) are applied exactly once. An existing totals file without a state file is taken as a
+# baseline that is up to date with the store: baseline() records it before any new day lands in the store.
+class CountryTotals:
+    def __init__(self, file=TOTALS_FILE, state_file=TOTALS_STATE_FILE, store=None):
+        self.file = file
+        self.state_file = state_file
+        self.store = store or AggregateStore()
+
+    def load(self):
+        if not os.path.exists(self.file):
+            return pd.DataFrame(
+                index=pd.Index([], name='road_type'),
+                columns=pd.MultiIndex(levels=[[]] * 3, codes=[[]] * 3, names=['country', 'state', 'element']))
+        return pd.read_pickle(self.file, compression='gzip')
+
+    def applied_days(self):
+        if not os.path.exists(self.state_file):
+            return None
+        return set(json.load(open(self.state_file))['applied_days'])
+
+    # elements created in the given day partitions, in the layout of the totals
+    def delta(self, manifest):
+        cube = AggregateCube.from_store(self.store, manifest)
+        df = cube.query(operation=['create'], group_by=['road_type', 'country', 'state', 'element'])
+        df = df.astype({level: object for level in ['road_type', 'country', 'state', 'element']})
+        return df.set_index(['road_type', 'country', 'state', 'element'])['count'].unstack(['country', 'state', 'element'])
+
+    def write_state(self, applied):
+        tmp = f'{self.state_file}.{os.getpid()}.tmp'
+        json.dump({'applied_days': sorted(applied)}, open(tmp, 'w'))
+        os.replace(tmp, self.state_file)
+
+    # writes the state file if there is none: every day of the store is taken as applied if a totals file
+    # exists, none otherwise. Must run before new days are written to the store (the job runs it before
+    # starting the day workers), otherwise they would be taken as already counted.
+    def baseline(self):
+        Path(self.file).parent.mkdir(parents=True, exist_ok=True)
+        with open(f'{self.state_file}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.applied_days() is None:
+                self.write_state(set(self.store.manifest()['partitions']) if os.path.exists(self.file) else set())
+
+    # applies every day of the store that is not in the totals yet. Returns the applied days.
+    def update(self):
+        Path(self.file).parent.mkdir(parents=True, exist_ok=True)
+        with open(f'{self.state_file}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.store.manifest()
+            applied = self.applied_days()
+            if applied is None:
+                if os.path.exists(self.file):
+                    raise RuntimeError(f'{self.file} has no state file, run baseline() before adding days to the store')
+                applied = set()
+
+            new_days = {day: file for day, file in manifest['partitions'].items() if day not in applied}
+            if new_days:
+                delta = self.delta({'version': manifest['version'], 'partitions': new_days})
+                totals = self.load().add(delta, fill_value=0).fillna(0)
+                tmp = f'{self.file}.{os.getpid()}.tmp'
+                totals.sort_index().sort_index(axis=1).to_pickle(tmp, compression='gzip')
+                os.replace(tmp, self.file)
+
+            self.write_state(applied | set(new_days))
+            return sorted(new_days)
+
+
+
+# lists and sets of a query's parameters are order insensitive (filters), tuples are kept as given
+def normalize_params(params):
+    return tuple(sorted(
+        (name, tuple(sorted(set(value))) if isinstance(value, (list, set, frozenset)) else value)
+        for name, value in params.items()
+    ))
+
+
+# memory held by a cached value (frames, arrays, and tuples/lists/dicts of them), object columns included
+def value_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(value_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(value_nbytes(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+# thread safe LRU cache, bounded by the number of entries and by their total memory (values larger than
+# max_bytes are returned without being cached). Values are shared, callers must not modify them.
+class LRUCache:
+    def __init__(self, max_entries=128, max_bytes=256 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = compute()
+        size = value_nbytes(value)
+        if size > self.max_bytes:
+            return value
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.sizes[key]
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.nbytes += size
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                old_key, _ = self.entries.popitem(last=False)
+                self.nbytes -= self.sizes.pop(old_key)
+        return value
+
+
+
+# Read-only snapshot of the aggregates (cube and percentage denominators) shared by all the dashboard sessions
+# of a process (panel serve re-runs the app script per session, but imported modules are loaded once).
+# It is reloaded only when the store's history file or the totals state change, i.e. once the collection job has
+# landed new days and applied them to the totals (both are written after all the day partitions of a run, so a
+# reload never sees a run half done), and the process holds a single copy of the history whatever the number of
+# sessions. The history itself is memory mapped, its pages are shared with the other panel workers.
+# Query results are memoized per snapshot, so a new data version starts with an empty cache.
+class AggregateSnapshot:
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, version, cube, prefix, totals, cache_entries=128, cache_bytes=256 * 2**20):
+        self.version = version
+        self.cube = cube
+        self.prefix = prefix
+        self.totals = totals
+        self.cache = LRUCache(cache_entries, cache_bytes)
+
+    @staticmethod
+    def data_version(store, totals):
+        return tuple(os.stat(f).st_mtime_ns if os.path.exists(f) else 0 for f in [store.history_file, totals.state_file])
+
+    @classmethod
+    def current(cls):
+        store = AggregateStore()
+        totals = CountryTotals(store=store)
+        version = cls.data_version(store, totals)
+        with cls._lock:
+            if cls._current is None or cls._current.version != version:
+                manifest = store.manifest()
+                cube = AggregateCube.from_store(store, manifest)
+                prefix = DayPrefixIndex.read(store, manifest)
+                if prefix is None:
+                    prefix = DayPrefixIndex.build(cube)
+                cls._current = cls(version, cube, prefix, totals.load())
+            return cls._current
+
+    # compute() memoized on name and the normalized params it depends on
+    def cached(self, name, compute, **params):
+        return self.cache.get((name, normalize_params(params)), compute)
+
+    def query(self, start=None, end=None, group_by=None, **filters):
+        group_by = tuple(group_by) if group_by is not None else None
+        return self.cached(
+            'query', lambda: self.cube.query(start, end, group_by, **filters),
+            start=start, end=end, group_by=group_by, **filters)